@@ -8,15 +8,20 @@ import sqlite3
 
 import google.generativeai as genai
 
-## Configure Genai Key
+## Configure Genai Key and load the model once per process
+
+
+@st.cache_resource
+def get_model():
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    return genai.GenerativeModel("gemini-2.0-flash")
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
 ## Function To Load Google Gemini Model and provide queries as response
 
 
 def get_gemini_response(question, prompt):
-    model = genai.GenerativeModel("gemini-2.0-flash")
+    model = get_model()
     response = model.generate_content([prompt[0], question])
     return response.text
 
@@ -4,8 +4,15 @@ from sqlalchemy import create_engine, text
 import pandas as pd
 from dotenv import load_dotenv
 import os
+import json
+import re
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import requests
+import threading
+import time
+from collections import OrderedDict
+import sqlglot
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,56 +27,169 @@ DB_PORT = os.getenv("DB_PORT")
 # Get the Google API key
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-# Configure Google Genai Key
-genai.configure(api_key=GOOGLE_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")
+# Bound each Gemini call so a stalled upstream cannot hang the Streamlit session
+GEMINI_TIMEOUT = 20  # seconds
+GEMINI_MAX_ATTEMPTS = 3
 
+# Maximum number of SELECT rows pulled from the database for display
+MAX_RESULT_ROWS = 10_000
+# Maximum number of rows, characters of row data and characters per cell sent to Gemini
+# when explaining a result
+MAX_EXPLANATION_ROWS = 20
+MAX_EXPLANATION_CHARS = 3000
+MAX_EXPLANATION_CELL_CHARS = 200
+EXPLANATION_ERROR = "Error generating explanation."
 
-# Create a connection to the database using SQLAlchemy
-def create_connection():
-    try:
-        engine = create_engine(
-            f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-        )
-        conn = engine.connect()
-        return engine, conn
-    except Exception as e:
-        st.error(f"Error connecting to the database: {e}")
-        return None, None
 
+# Configure Google Genai Key and load the model once per process instead of on every rerun
+@st.cache_resource
+def get_model():
+    genai.configure(api_key=GOOGLE_API_KEY)
+    return genai.GenerativeModel("gemini-1.5-flash")
 
-# Function to execute SQL query and return the result
-def execute_query(query):
-    engine, conn = create_connection()
-    if conn is not None:
-        try:
+
+# Create the SQLAlchemy engine once per process so its connection pool is reused across reruns
+@st.cache_resource
+def get_engine():
+    return create_engine(
+        f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}",
+        pool_size=10,
+        max_overflow=20,
+        pool_pre_ping=True,  # Transparently replace connections dropped by the server
+        pool_recycle=1800,
+        query_cache_size=1200,  # Compiled statement cache, shared by every session in the process
+    )
+
+
+# Statement types that return rows; WITH ... SELECT also parses as a select
+ROW_RETURNING_STATEMENTS = {"select", "union", "intersect", "except"}
+
+
+# Function to parse the SQL query locally, so malformed queries never reach the database.
+# Only a single statement is accepted, since it alone decides how the query is executed.
+def parse_query(query):
+    try:
+        statements = [
+            statement
+            for statement in sqlglot.parse(query, read="postgres")
+            if statement is not None
+        ]
+    except sqlglot.errors.SqlglotError as e:  # Covers tokenizer errors such as unclosed quotes
+        st.error(f"Invalid SQL query: {e}")
+        return None
+
+    if len(statements) != 1:
+        st.error("Please enter exactly one SQL statement.")
+        return None
+    return statements[0]
+
+
+# Function to cap the number of rows a SELECT returns, so the database never sends rows
+# that would not be displayed. A query that already has a smaller LIMIT is left untouched,
+# and any other existing LIMIT/FETCH is kept by wrapping the query in a limited subquery.
+def limit_query(query, parsed, max_rows):
+    limit = parsed.args.get("limit")
+    if limit is None:
+        return parsed.limit(max_rows).sql(dialect="postgres")
+
+    if isinstance(limit, sqlglot.exp.Limit):
+        count = limit.expression
+    else:
+        count = limit.args.get("count")  # FETCH FIRST n ROWS ONLY
+    if count is not None and count.is_int and int(count.name) <= max_rows:
+        return query
+    return (
+        sqlglot.select("*")
+        .from_(parsed.subquery("result"))
+        .limit(max_rows)
+        .sql(dialect="postgres")
+    )
+
+
+# Function to check whether a parsed query returns rows
+def is_select_query(parsed):
+    return parsed.key in ROW_RETURNING_STATEMENTS
+
+
+# Function to execute SQL query and return the result. Returns None if the query failed
+# (the error is already reported), and an empty DataFrame for successful non-SELECT queries.
+def execute_query(query, parsed):
+    is_select = is_select_query(parsed)
+    try:
+        # Check a connection out of the pool; begin() commits on success and rolls back on error
+        engine = get_engine()
+        with engine.begin() as conn:
             # Check if it's a SELECT query
-            if query.strip().lower().startswith("select"):
-                # Use Pandas to execute the query and return the result as a DataFrame for SELECT queries
-                df = pd.read_sql(query, conn)
-                conn.close()
+            if is_select:
+                # Use Pandas to execute the query and return the result as a DataFrame for SELECT queries.
+                # One row past the display limit is fetched to tell whether the result was cut off.
+                df = pd.read_sql_query(
+                    text(limit_query(query, parsed, MAX_RESULT_ROWS + 1)),
+                    conn,
+                    dtype_backend="pyarrow",
+                )
+                truncated = len(df) > MAX_RESULT_ROWS
+                df = df.head(MAX_RESULT_ROWS)
+                df.attrs["truncated"] = truncated
                 return df
             else:
                 # For INSERT, UPDATE, DELETE use connection.execute() instead
-                with conn.begin():  # Ensures transaction management (commit or rollback)
-                    conn.execute(text(query))  # Execute the non-SELECT query safely
-                conn.close()
-                return None  # No rows are returned for non-SELECT queries
-        except Exception as e:
-            st.error(f"Error executing the query: {e}")
-            return None
-    return None
+                conn.execute(text(query))  # Execute the non-SELECT query safely
+                return pd.DataFrame()  # No rows are returned for non-SELECT queries
+    except Exception as e:
+        st.error(f"Error executing the query: {e}")
+        return None
 
 
-# Function to get SQL query suggestion from Gemini Pro
-def get_sql_suggestion(user_input):
-    if not user_input:
-        return ""
+# Function to retry a Gemini call with exponential backoff on timeouts and transient errors
+def call_with_retries(func, *args, **kwargs):
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        try:
+            return func(*args, **kwargs)
+        except (
+            google_exceptions.DeadlineExceeded,
+            google_exceptions.ServiceUnavailable,
+        ):
+            if attempt == GEMINI_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(0.5 * 2**attempt)
+
+
+# Function to call Gemini Pro, memoized on the prompt so repeated requests skip the API round-trip.
+# Exceptions are not cached, so a failed call is retried on the next rerun.
+# st.cache_data computes each key under a lock, so sessions asking for the same explanation
+# at the same time share a single Gemini call rather than each sending their own.
+@st.cache_data(ttl=3600, show_spinner=False)
+def generate_response(prompt):
+    model = get_model()
+    response = call_with_retries(
+        model.generate_content,
+        prompt,
+        request_options={"timeout": GEMINI_TIMEOUT},
+    )
+    if hasattr(response, "text"):
+        return response.text
+    return None
 
-    try:
-        # Define the examples and the prompt for generating a SQL query suggestion
-        prompt = f"""
-        As a SQL expert, generate a PostgreSQL query based on the user's request: "{user_input}". 
+
+# Function to stream a Gemini Pro response into a placeholder as it is generated
+def stream_response(prompt, placeholder):
+    model = get_model()
+    response = model.generate_content(
+        prompt, stream=True, request_options={"timeout": GEMINI_TIMEOUT}
+    )
+    response_text = ""
+    for chunk in response:
+        response_text += chunk.text
+        placeholder.code(response_text, language="sql")
+    return response_text
+
+
+# Define the examples and the prompt for generating a SQL query suggestion once; the static
+# text is split around the user's request so the prompt is not re-formatted on every call
+SQL_PROMPT_PREFIX = """
+        As a SQL expert, generate a PostgreSQL query based on the user's request: \""""
+SQL_PROMPT_SUFFIX = """". 
         Ensure the query is syntactically correct and relevant to the request.
         If the request is unclear or cannot be translated to a SQL query, respond with an empty string.
 
@@ -98,32 +218,91 @@ def get_sql_suggestion(user_input):
         Now, based on the user's input, generate a similar SQL query.
         """
 
-        response = model.generate_content(prompt)
-        if hasattr(response, "text"):
-            # Clean up the generated query by stripping out surrounding backticks, newlines, and extra spaces
-            suggested_query = response.text.strip()
-            # Remove the backticks (```) and make it a single line
-            if suggested_query.startswith("```sql") and suggested_query.endswith("```"):
-                suggested_query = suggested_query[
-                    7:-3
-                ].strip()  # Strip the triple backticks and extra spaces
-            return suggested_query
-        else:
-            return ""
+# Matches a response wrapped in a Markdown code fence, with or without a SQL language tag
+SQL_FENCE = re.compile(
+    r"^\s*```(?:sql|postgres(?:ql)?|psql)?\s*(.*?)\s*```\s*$", re.IGNORECASE | re.DOTALL
+)
+
+
+# Function to generate a SQL query suggestion from Gemini Pro, streaming the partial query into
+# a placeholder which is cleared once the full suggestion is in
+def suggest_sql(user_input):
+    # The user's request is the only part of the prompt that changes between calls
+    prompt = SQL_PROMPT_PREFIX + user_input + SQL_PROMPT_SUFFIX
+
+    placeholder = st.empty()
+    # A retry restarts the stream, so the placeholder is simply overwritten
+    response_text = call_with_retries(stream_response, prompt, placeholder)
+    placeholder.empty()  # The final query is shown in the text area below
+    if response_text:
+        # Clean up the generated query by stripping out surrounding backticks, newlines, and extra spaces
+        match = SQL_FENCE.match(response_text)
+        return (match.group(1) if match else response_text).strip()
+    return ""
+
+
+# Process-wide LRU cache of SQL suggestions, keyed on the whitespace-normalized request, so
+# repeated requests from any session skip the API round-trip
+SUGGESTION_CACHE = OrderedDict()
+SUGGESTION_CACHE_SIZE = 512
+SUGGESTION_CACHE_LOCK = threading.Lock()
+
+
+# Function to get SQL query suggestion from Gemini Pro
+def get_sql_suggestion(user_input):
+    # Normalize whitespace only: case is kept in the key and the prompt, since literal values
+    # such as 'Male' are case-sensitive in PostgreSQL
+    cache_key = " ".join(user_input.split())
+    if not cache_key:
+        return ""
+
+    with SUGGESTION_CACHE_LOCK:
+        if cache_key in SUGGESTION_CACHE:
+            SUGGESTION_CACHE.move_to_end(cache_key)
+            return SUGGESTION_CACHE[cache_key]
+
+    try:
+        suggested_query = suggest_sql(user_input.strip())
     except Exception as e:
         st.error(f"Error generating SQL suggestion: {e}")
         return ""
 
+    # Empty suggestions are not cached, so a single bad response is retried on the next request
+    if suggested_query:
+        with SUGGESTION_CACHE_LOCK:
+            SUGGESTION_CACHE[cache_key] = suggested_query
+            SUGGESTION_CACHE.move_to_end(cache_key)
+            if len(SUGGESTION_CACHE) > SUGGESTION_CACHE_SIZE:
+                SUGGESTION_CACHE.popitem(last=False)
+    return suggested_query
+
+
+# Function to cut a long cell value down to MAX_EXPLANATION_CELL_CHARS characters
+def shorten_value(value):
+    value_str = str(value)
+    if len(value_str) > MAX_EXPLANATION_CELL_CHARS:
+        return value_str[:MAX_EXPLANATION_CELL_CHARS] + "..."
+    return value
+
 
 # Function to get a summarized response for the SQL query result using Gemini Pro
 def get_sql_response_explanation(df, user_input):
-    # Convert the dataframe to a string for input to Gemini model
-    df_str = df.to_string(index=False)
+    # Convert a sample of the dataframe to compact JSON records for input to Gemini model.
+    # Long cell values are shortened first, then whole records are dropped from the end
+    # until the JSON fits the size budget.
+    sample = [
+        {column: shorten_value(value) for column, value in record.items()}
+        for record in df.head(MAX_EXPLANATION_ROWS).to_dict(orient="records")
+    ]
+    df_str = json.dumps(sample, default=str, separators=(",", ":"))
+    while sample and len(df_str) > MAX_EXPLANATION_CHARS:
+        sample.pop()
+        df_str = json.dumps(sample, default=str, separators=(",", ":"))
 
     # Creating a prompt for Gemini Pro to summarize the results
     prompt = f"""
     The user asked: "{user_input}"
-    The SQL query results are as follows:
+    The SQL query returned {len(df)} rows. The first {len(sample)} rows are as follows:
     {df_str}
 
     Provide a short 1-2 sentence summary of the results as an answer to the user's query.
@@ -131,43 +310,80 @@ def get_sql_response_explanation(df, user_input):
     """
 
     try:
-        response = model.generate_content(prompt)
-        if hasattr(response, "text"):
-            return response.text.strip()
+        response_text = generate_response(prompt)
+        if response_text is not None:
+            return response_text.strip()
         else:
-            return "Error generating explanation."
+            return EXPLANATION_ERROR
     except Exception as e:
         st.error(f"Error generating response with Gemini: {e}")
-        return "Error generating explanation."
+        return EXPLANATION_ERROR
+
+
+# Function to drop the SELECT result and explanation stored in this session
+def clear_stored_result():
+    for key in ("result_df", "result_need", "result_explanation"):
+        st.session_state.pop(key, None)
 
 
 # Streamlit UI
 def app():
     st.title("SQL Query Executor with Gemini Pro Suggestion and Explanation")
 
-    user_need = st.text_input("Describe your data need to get a SQL query suggestion:")
+    # Only ask Gemini for a suggestion when the form is submitted, not on every keystroke
+    with st.form("suggest_form"):
+        user_need = st.text_input(
+            "Describe your data need to get a SQL query suggestion:"
+        )
+        submitted = st.form_submit_button("Suggest SQL")
 
-    # Get SQL suggestion from Gemini
-    suggested_query = get_sql_suggestion(user_need)
+    if submitted:
+        # Get SQL suggestion from Gemini and keep it across reruns
+        st.session_state["suggested_query"] = get_sql_suggestion(user_need)
+
+    suggested_query = st.session_state.get("suggested_query", "")
 
     query = st.text_area("LLM Converted SQL query:", value=suggested_query, height=150)
 
     if st.button("Execute Query"):
         if query:
-            result_df = execute_query(query)
-            if result_df is not None and not result_df.empty:
-                st.write("Query Results:")
-                st.dataframe(result_df)  # Display the results as a table
-
-                # Get explanation for SQL result using Gemini Pro
-                explanation = get_sql_response_explanation(result_df, user_need)
-                st.write("End user response:")
-                st.write(explanation)
-            else:
-                st.success("Query executed successfully, no result to display.")
+            parsed = parse_query(query)
+            # An invalid query is already reported by parse_query, keep showing the last result
+            if parsed is not None:
+                # Always run the query on an explicit click: it may modify data (e.g. a DELETE in a
+                # CTE) or read data changed since, so a stored result cannot stand in for it
+                result_df = execute_query(query, parsed)
+
+                # A None result means the query failed and execute_query already reported it
+                if result_df is not None:
+                    clear_stored_result()
+                    if not result_df.empty:
+                        # Only the latest result is kept, so session state does not grow per query
+                        st.session_state["result_df"] = result_df
+                        st.session_state["result_need"] = user_need
+                    else:
+                        st.success("Query executed successfully, no result to display.")
         else:
             st.warning("Please enter a SQL query.")
 
+    # Show the latest SELECT result on every rerun, not only right after Execute is clicked
+    if "result_df" in st.session_state:
+        result_df = st.session_state["result_df"]
+        st.write("Query Results:")
+        st.dataframe(result_df)  # Display the results as a table
+        if result_df.attrs.get("truncated"):
+            st.caption(f"Showing the first {MAX_RESULT_ROWS} rows.")
+
+        explanation = st.session_state.get("result_explanation")
+        if explanation is None:
+            # Get explanation for SQL result using Gemini Pro
+            explanation = get_sql_response_explanation(
+                result_df, st.session_state["result_need"]
+            )
+            if explanation != EXPLANATION_ERROR:  # Retry failed explanations on the next rerun
+                st.session_state["result_explanation"] = explanation
+        st.write("End user response:")
+        st.write(explanation)
 
 if __name__ == "__main__":
     app()